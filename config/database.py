@@ -4,7 +4,6 @@ from .config import DATABASE_URL
 
 engine = create_engine(DATABASE_URL)
 metadata = MetaData()
-metadata.reflect(bind=engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Dependency to get the database session
@@ -15,6 +14,8 @@ def get_session():
     finally:
         db.close()
 
-# Dependency to get the metadata
+# Dependency to get the metadata, reflected from the database on first use
 def get_metadata():
+    if not metadata.tables:
+        metadata.reflect(bind=engine)
     return metadata
\ No newline at end of file
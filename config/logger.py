@@ -0,0 +1,45 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None
+_queue_handler = None
+
+# Configure the root logger once for the whole app. Request threads only put
+# records on a queue; a background listener thread does the console and
+# file writes, so no handler blocks on stderr or disk. Safe to call again:
+# it does nothing while logging is running, and restarts it after
+# shutdown_logging().
+def setup_logging(level: int = logging.INFO):
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(), logging.FileHandler("app.log")]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    _queue_handler = QueueHandler(log_queue)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_queue_handler)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+# Flushes queued records, then detaches the queue so later records fall back
+# to Python's default stderr output instead of piling up unread
+def shutdown_logging():
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+
+    logging.getLogger().removeHandler(_queue_handler)
+    listener, _listener, _queue_handler = _listener, None, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -1,26 +1,74 @@
 import streamlit as st
-import requests
+import httpx
 from streamlit_webrtc import webrtc_streamer, AudioProcessorBase, RTCConfiguration
 import numpy as np
-from pydub import AudioSegment
-import tempfile
+import io
 import os
 import threading
+import soundfile as sf
 import av
 
 # Configuration
 st.set_page_config(page_title="Code&Clause Chat", page_icon="💼")
-BASE_URL = "http://127.0.0.1:8000"
+BASE_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+SAMPLE_RATE = 48000
+MAX_RECORDING_SECONDS = 120
+RECENT_HISTORY = 20  # entries fetched and rendered by default
+EARLIER_PAGE = 50  # entries per "Load earlier messages" click; backend caps pages at 100
+
+@st.cache_resource
+def http_client() -> httpx.Client:
+    # Shared by every browser session of this Streamlit process, so all users
+    # reuse the same warm keep-alive connections to the backend. Credentials
+    # are therefore passed per request, never set on the client. Chat replies
+    # wait on the LLM, so only the connect phase gets a short timeout.
+    # HTTP/2 is negotiated via TLS ALPN, so it applies to an https BACKEND_URL;
+    # plain http falls back to keep-alive HTTP/1.1.
+    return httpx.Client(
+        base_url=BASE_URL,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=4),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+    )
+
+def auth_headers() -> dict:
+    return {"Authorization": f"Bearer {st.session_state.get('token')}"}
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_history(token: str, skip: int, limit: int) -> list:
+    # One page of history, `skip` entries back from the newest. Keyed by token
+    # and page so reruns (widget changes, button clicks) don't refetch;
+    # raising on errors keeps failed responses out of the cache
+    resp = http_client().get(
+        "/chatbot/history/",
+        params={"skip": skip, "limit": limit},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+def earlier_page_skip(page: int) -> int:
+    return RECENT_HISTORY + page * EARLIER_PAGE
+
+def clear_history(token: str):
+    # A new message shifts every page back by one, so drop the cached pages
+    # this session fetched and collapse the earlier messages again
+    fetch_history.clear(token, 0, RECENT_HISTORY)
+    for page in range(st.session_state.history_pages):
+        fetch_history.clear(token, earlier_page_skip(page), EARLIER_PAGE)
+    st.session_state.history_pages = 0
 
 # Initialize session state
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 if "audio_frames" not in st.session_state:
     st.session_state.audio_frames = []
-if "wav_bytes" not in st.session_state:
-    st.session_state.wav_bytes = None
+if "voice_bytes" not in st.session_state:
+    st.session_state.voice_bytes = None
 if "audio_captured" not in st.session_state:
     st.session_state.audio_captured = False
+if "history_pages" not in st.session_state:
+    st.session_state.history_pages = 0  # earlier-message pages loaded on request
 
 # Sidebar Navigation
 st.sidebar.title("🔍 Navigation")
@@ -39,8 +87,8 @@ def signup():
     st.selectbox("Role 🎭", ["staff", "admin"], key="signup_role")
 
     if st.button("Sign Up 🚀", key="signup_btn"):
-        resp = requests.post(
-            f"{BASE_URL}/auth/signup",
+        resp = http_client().post(
+            "/auth/signup",
             json={
                 "first_name": st.session_state.signup_first,
                 "last_name": st.session_state.signup_last,
@@ -60,8 +108,8 @@ def login():
     st.text_input("Password 🔒", type="password", key="login_pwd")
 
     if st.button("Login ✅", key="login_btn"):
-        resp = requests.post(
-            f"{BASE_URL}/auth/login",
+        resp = http_client().post(
+            "/auth/login",
             data={"username": st.session_state.login_email, "password": st.session_state.login_pwd},
         )
         if resp.status_code == 200:
@@ -81,8 +129,7 @@ def profile():
         st.warning("⚠️ Please log in first.")
         return
     
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{BASE_URL}/auth/user/me", headers=headers)
+    response = http_client().get("/auth/user/me", headers=auth_headers())
     if response.status_code == 200:
         user_data = response.json()
         
@@ -106,34 +153,57 @@ def profile():
 
 class AudioProcessor(AudioProcessorBase):
     def __init__(self):
-        self.frames = []
+        # Fixed-size ring buffer of PCM16 samples, written in place by recv().
+        # Once full, the oldest samples are overwritten.
+        self.buffer = np.empty(SAMPLE_RATE * MAX_RECORDING_SECONDS, dtype=np.int16)
+        self.write_idx = 0  # total samples written since the last drain()
         self.lock = threading.Lock()
         
     def recv(self, frame: av.AudioFrame) -> av.AudioFrame:
+        samples = frame.to_ndarray().reshape(-1)
         with self.lock:
-            self.frames.append(frame.to_ndarray())
+            self._write(samples)
         return frame
 
+    def _write(self, samples: np.ndarray):
+        size = self.buffer.size
+        if samples.size >= size:
+            samples = samples[-size:]
+        start = self.write_idx % size
+        end = start + samples.size
+        if end <= size:
+            self.buffer[start:end] = samples
+        else:
+            split = size - start
+            self.buffer[start:] = samples[:split]
+            self.buffer[:end - size] = samples[split:]
+        self.write_idx += samples.size
+
+    def drain(self) -> np.ndarray:
+        # Takes the recorded samples (in recording order) and restarts with an
+        # empty buffer. Only the swap runs under the lock, so recv() on the
+        # WebRTC thread never waits for the caller's conversion work.
+        fresh = np.empty_like(self.buffer)
+        with self.lock:
+            buffer, written = self.buffer, self.write_idx
+            self.buffer, self.write_idx = fresh, 0
+        if written <= buffer.size:
+            return buffer[:written]
+        start = written % buffer.size
+        return np.concatenate((buffer[start:], buffer[:start]))
+
 def chat():
     st.subheader("🤖 Chat with Code&Clause")
     token = st.session_state.get("token")
     if not token:
         st.warning("Login to access chat.")
         return
-    headers = {"Authorization": f"Bearer {token}"}
-
-    # Display history
-    hist_resp = requests.get(f"{BASE_URL}/chatbot/history/", headers=headers)
-    if hist_resp.status_code == 200:
-        for entry in hist_resp.json():
-            st.markdown(f"**You:** {entry['user_input']}")
-            st.markdown(f"**Bot:** {entry['response']} -- *{entry['timestamp']}*")
-            st.markdown("---")
 
     # File upload
     uploaded = st.file_uploader("Upload file to send", type=None, key="file_upload")
 
-    # Voice recording section
+    # Voice recording section. The streamer stays outside the fragment below so
+    # its WebRTC peer connection isn't torn down by chat interactions.
     st.markdown("### 🎤 Record Voice Message")
     
     webrtc_ctx = webrtc_streamer(
@@ -145,89 +215,120 @@ def chat():
         audio_processor_factory=AudioProcessor,
     )
 
+    chat_panel(token, uploaded, webrtc_ctx)
+
+def render_entry(entry: dict):
+    st.markdown(f"**You:** {entry['user_input']}")
+    st.markdown(f"**Bot:** {entry['response']} -- *{entry['timestamp']}*")
+    st.markdown("---")
+
+@st.fragment
+def chat_panel(token, uploaded, webrtc_ctx):
+    # Clicks in here only rerun this fragment, not the whole page
+
+    # Display the recent history, reusing the copy returned by the last send
+    # if there is one. Earlier messages are only fetched and rendered once
+    # the user asks for them, a page at a time.
+    recent = st.session_state.pop("chat_history", None)
+    if recent is None:
+        try:
+            recent = fetch_history(token, 0, RECENT_HISTORY)
+        except httpx.HTTPError:
+            recent = []
+
+    older, more_available = [], len(recent) >= RECENT_HISTORY
+    for page in reversed(range(st.session_state.history_pages)):
+        try:
+            entries = fetch_history(token, earlier_page_skip(page), EARLIER_PAGE)
+        except httpx.HTTPError:
+            entries = []
+        if page == st.session_state.history_pages - 1:
+            more_available = len(entries) >= EARLIER_PAGE
+        older.extend(entries)
+
+    if more_available and st.button("Load earlier messages", key="load_earlier"):
+        st.session_state.history_pages += 1
+        st.rerun(scope="fragment")
+    for entry in older:
+        render_entry(entry)
+    for entry in recent:
+        render_entry(entry)
+
     # Capture audio button
     if st.button("📸 Capture Audio"):
         if webrtc_ctx and webrtc_ctx.audio_processor:
-            with webrtc_ctx.audio_processor.lock:
-                audio_frames = webrtc_ctx.audio_processor.frames
+            audio_data = webrtc_ctx.audio_processor.drain()
+            
+            if audio_data.size:
+                # Opus in Ogg is roughly a tenth of the size of 48 kHz PCM WAV
+                buf = io.BytesIO()
+                sf.write(buf, audio_data, SAMPLE_RATE, format="OGG", subtype="OPUS")
+                st.session_state.voice_bytes = buf.getvalue()
                 
-                if audio_frames:
-                    # Convert frames to audio
-                    audio_data = np.concatenate(audio_frames, axis=0)
-                    
-                    # Create audio segment
-                    audio_segment = AudioSegment(
-                        audio_data.tobytes(),
-                        sample_width=2,
-                        frame_rate=48000,
-                        channels=1
-                    )
-                    
-                    # Save to bytes in session state
-                    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-                        audio_segment.export(tmp.name, format="wav")
-                        with open(tmp.name, "rb") as f:
-                            st.session_state.wav_bytes = f.read()
-                        os.unlink(tmp.name)
-                    
-                    st.session_state.audio_captured = True
-                    st.success(f"Captured {len(audio_data)/48000:.2f}s of audio!")
-                    webrtc_ctx.audio_processor.frames = []  # Clear frames
-                else:
-                    st.warning("No audio captured. Please speak and try again.")
+                st.session_state.audio_captured = True
+                st.success(f"Captured {len(audio_data)/SAMPLE_RATE:.2f}s of audio!")
+            else:
+                st.warning("No audio captured. Please speak and try again.")
 
     # Show captured audio and action buttons
-    if st.session_state.audio_captured and st.session_state.wav_bytes:
-        st.audio(st.session_state.wav_bytes, format="audio/wav")
+    if st.session_state.audio_captured and st.session_state.voice_bytes:
+        st.audio(st.session_state.voice_bytes, format="audio/ogg")
         
         col1, col2 = st.columns(2)
         with col1:
             if st.button("Send Audio"):
-                data = {"user_input": "<voice message>"}
-                files = {"file": ("voice.wav", st.session_state.wav_bytes, "audio/wav")}
+                data = {"user_input": "<voice message>", "history_limit": RECENT_HISTORY}
+                files = {"file": ("voice.ogg", st.session_state.voice_bytes, "audio/ogg")}
                 
                 with st.spinner("Sending audio..."):
-                    resp = requests.post(
-                        f"{BASE_URL}/chatbot/", 
+                    resp = http_client().post(
+                        "/chatbot/batch", 
                         data=data, 
-                        headers=headers, 
+                        headers=auth_headers(), 
                         files=files
                     )
                 
                 if resp.status_code == 200:
+                    clear_history(token)
+                    st.session_state.chat_history = resp.json()["history"]
                     st.session_state.audio_captured = False
-                    st.session_state.wav_bytes = None
-                    st.rerun()  # Refresh after successful response
+                    st.session_state.voice_bytes = None
+                    st.rerun(scope="fragment")  # Refresh after successful response
                 else:
                     st.error(f"Error: {resp.text}")
                 
         with col2:
             if st.button("Delete Audio"):
                 st.session_state.audio_captured = False
-                st.session_state.wav_bytes = None
-                st.rerun()
+                st.session_state.voice_bytes = None
+                st.rerun(scope="fragment")
 
     # Text input
     user_input = st.text_input("Type a message...", key="chat_input")
 
     # Send text message button
     if st.button("Send Message", key="send_msg") and user_input:
-        data = {"user_input": user_input}
+        data = {"user_input": user_input, "history_limit": RECENT_HISTORY}
         files = None
         
         if uploaded:
-            files = {"file": (uploaded.name, uploaded.getvalue(), uploaded.type)}
+            # UploadedFile is already an in-memory buffer; stream it as-is
+            # rather than copying it out with getvalue()
+            uploaded.seek(0)
+            files = {"file": (uploaded.name, uploaded, uploaded.type)}
         
         with st.spinner("Sending message..."):
-            resp = requests.post(
-                f"{BASE_URL}/chatbot/", 
+            resp = http_client().post(
+                "/chatbot/batch", 
                 data=data, 
-                headers=headers, 
+                headers=auth_headers(), 
                 files=files
             )
             
             if resp.status_code == 200:
-                st.rerun()  # Refresh after successful response
+                clear_history(token)
+                st.session_state.chat_history = resp.json()["history"]
+                st.rerun(scope="fragment")  # Refresh after successful response
             else:
                 st.error(f"Error: {resp.text}")
 
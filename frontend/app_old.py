@@ -3,8 +3,7 @@ import requests
 from streamlit_webrtc import webrtc_streamer, AudioProcessorBase, RTCConfiguration
 import numpy as np
 from pydub import AudioSegment
-import tempfile
-import os
+import io
 import queue
 import threading
 
@@ -185,27 +184,22 @@ def chat():
                     frame_rate=48000,
                     channels=1,
                 )
-                with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp:
-                    wav.export(tmp.name, format='wav')
-                    # Reopen the file for reading
-                    with open(tmp.name, 'rb') as audio_file:
-                        files = {"file": (os.path.basename(tmp.name), audio_file, 'audio/wav')}
-                        
-                        with st.spinner("Bot is thinking... 💡"):
-                            resp = requests.post(
-                                f"{BASE_URL}/chatbot/", data=data, headers=headers, files=files
-                            )
-                            if resp.status_code == 200:
-                                st.markdown(f"**Bot:** {resp.json()['response']}")
-                                # Set flag to reset input after successful submission
-                                st.session_state["_reset_input"] = True
-                                # Clear audio frames after sending
-                                st.session_state.audio_frames = []
-                            else:
-                                st.error(f"Error contacting API: {resp.text}")
+                buf = io.BytesIO()
+                wav.export(buf, format='wav')
+                files = {"file": ("voice.wav", buf.getvalue(), 'audio/wav')}
                 
-                # Clean up temp file
-                os.unlink(tmp.name)
+                with st.spinner("Bot is thinking... 💡"):
+                    resp = requests.post(
+                        f"{BASE_URL}/chatbot/", data=data, headers=headers, files=files
+                    )
+                    if resp.status_code == 200:
+                        st.markdown(f"**Bot:** {resp.json()['response']}")
+                        # Set flag to reset input after successful submission
+                        st.session_state["_reset_input"] = True
+                        # Clear audio frames after sending
+                        st.session_state.audio_frames = []
+                    else:
+                        st.error(f"Error contacting API: {resp.text}")
                 return
         
         # If no audio or just text input
@@ -1,30 +1,57 @@
 # app/main.py
 
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
+from config.logger import setup_logging, shutdown_logging
+
+# Configure logging before the modules below log at import time
+setup_logging()
+
 from config.database import engine
 from models import models
 from routers import auth, chatbot
 from rag.query_engine import lifespan
+from routers.helpers.helper import close_http_client
 
 # Load environment variables
 load_dotenv()
 
-# Initialize the FastAPI application with the lifespan context manager
-app = FastAPI(lifespan=lifespan)
+@asynccontextmanager
+async def app_lifespan(app: FastAPI):
+    # No-op on first start; restarts logging if a previous run shut it down
+    setup_logging()
+    try:
+        # Create all database tables. Opt-in (AUTO_CREATE_SCHEMA=1) so a normal
+        # boot, and every worker of a multi-worker one, skips the schema queries.
+        if os.getenv("AUTO_CREATE_SCHEMA") == "1":
+            models.Base.metadata.create_all(bind=engine)
+        try:
+            async with lifespan(app):
+                yield
+        finally:
+            await close_http_client()
+    finally:
+        shutdown_logging()
 
-# Create all database tables
-models.Base.metadata.create_all(bind=engine)
+# Initialize the FastAPI application with the lifespan context manager
+app = FastAPI(lifespan=app_lifespan, default_response_class=ORJSONResponse)
 
 # CORS configuration
+# Explicit allowlists let browsers cache the preflight for max_age seconds
+# instead of sending an OPTIONS request before every chat POST
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Adjust the origins to restrict access as needed
+    allow_origins=os.getenv("FRONTEND_ORIGINS", "http://localhost:8501").split(","),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 # Include routers
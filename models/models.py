@@ -6,7 +6,8 @@ from sqlalchemy import (
     DateTime,
     String,
     ForeignKey,
-    Enum
+    Enum,
+    Index
 )
 
 from enum import Enum as PyEnum
@@ -68,6 +69,9 @@ class User(Basemodel, Base):
 
 class ChatbotInteraction(Basemodel, Base):
     __tablename__ = "chatbot_interactions"
+    __table_args__ = (
+        Index("ix_chatinter_user_ts", "user_id", "timestamp"),  # per-user history lookups in time order
+    )
 
     user_id = Column(String(60), ForeignKey("users.id"), nullable=False)
     user_input = Column(String(15000), nullable=False)  # User's question
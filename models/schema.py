@@ -13,6 +13,10 @@ class ChatbotResponse(BaseModel):
         from_attributes = True  # Enables compatibility with SQLAlchemy models
         arbitrary_types_allowed = True
 
+class ChatbotBatchResponse(BaseModel):
+    reply: ChatbotResponse # The newly generated reply
+    history: list[ChatbotResponse] # The user's chat history, including the new reply
+
 class UserSignupSchema(BaseModel):
     first_name: str # User's first name
     last_name: str # User's last name
@@ -1,48 +1,51 @@
 # Standard library imports
 from contextlib import asynccontextmanager
+from functools import lru_cache
+import hashlib
+import json
 import logging
 import os
+import shutil
+import tempfile
 import time
 from typing import Any, List, Sequence
 
 # Third-party imports
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
+from filelock import FileLock, Timeout
+import pymupdf
 import torch
 
 # Google Gemini client
 import google.generativeai as genai
 
 # llama_index imports
-from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core import Document, Settings, StorageContext, VectorStoreIndex
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.embeddings import BaseEmbedding
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.llms.gemini import Gemini
-from llama_index.readers.file import PDFReader
 from llama_index.vector_stores.postgres import PGVectorStore
-
-# Sentence Transformers (for model saving)
-from sentence_transformers import SentenceTransformer
+from sqlalchemy import create_engine, inspect, text
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
 logger = logging.getLogger("rag_engine")
 
 # ─── Environment & Device ──────────────────────────────────────────────────────
 DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
 logger.info(f"Using device: {DEVICE}")
 
+# Half-precision embedding weights on GPU (set EMBED_FP16=false to opt out);
+# CPU inference always stays FP32
+EMBED_FP16 = DEVICE.startswith("cuda") and os.getenv("EMBED_FP16", "true").lower() == "true"
+EMBED_MODEL_KWARGS = {"model_kwargs": {"torch_dtype": torch.float16}} if EMBED_FP16 else {}
+if DEVICE.startswith("cuda"):
+    # Lets any remaining FP32 matmuls use tensor cores on Ampere and newer
+    torch.backends.cuda.matmul.allow_tf32 = True
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise RuntimeError("Set GOOGLE_API_KEY in .env to use Gemini API")
@@ -50,7 +53,65 @@ genai.configure(api_key=GOOGLE_API_KEY)
 
 BASE_PDF_DIR = os.getenv("PDF_INPUT_DIR", "rag/data/NITDA")
 
+# EMBED_DIM must match the model, e.g. 384 for all-MiniLM-L6-v2; switching
+# models requires re-indexing with FORCE_RELOAD_INDEX=true
+HF_MODEL_NAME = os.getenv("HF_EMBED_MODEL", "sentence-transformers/all-mpnet-base-v2")
+LOCAL_MODEL_PATH = os.path.join("cached_models", HF_MODEL_NAME.replace("/", "_"))
+# Serializes cold-start work (model download, PDF indexing) across workers
+STARTUP_LOCK_PATH = os.path.join("cached_models", ".lock")
+STARTUP_LOCK_TIMEOUT = int(os.getenv("STARTUP_LOCK_TIMEOUT", "600"))
+# Table beside the vector table recording which inputs it was last
+# force-rebuilt from, so a worker started later (crash restart, recycled
+# worker) doesn't clear and rebuild the shared table while the others are
+# serving. Delete its row to force a rebuild from unchanged inputs.
+INDEX_BUILDS_TABLE = "rag_index_builds"
+# Node parser settings; part of the index fingerprint
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 20
+# Bump whenever read_pdf_pages() changes the text or metadata it produces,
+# so the next force reload re-indexes
+PDF_PARSER_VERSION = 1
+# Texts per forward pass when embedding nodes; llama_index defaults to 10
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+@lru_cache(maxsize=1)
+def load_embed_model():
+    # Loaded at most once per process, however many times lifespan runs
+    os.makedirs("cached_models", exist_ok=True)
+
+    if os.path.exists(LOCAL_MODEL_PATH) and os.listdir(LOCAL_MODEL_PATH):
+        logger.info(f"Loading embedding model from local cache: {LOCAL_MODEL_PATH}")
+        return HuggingFaceEmbedding(
+            model_name=LOCAL_MODEL_PATH,
+            device=DEVICE,
+            embed_batch_size=EMBED_BATCH_SIZE,
+            **EMBED_MODEL_KWARGS
+        )
+
+    logger.info(f"Downloading embedding model: {HF_MODEL_NAME}")
+    embed_model = HuggingFaceEmbedding(
+        model_name=HF_MODEL_NAME,
+        device=DEVICE,
+        embed_batch_size=EMBED_BATCH_SIZE,
+        **EMBED_MODEL_KWARGS
+    )
+    # Save the already-loaded SentenceTransformer rather than loading it twice.
+    # It is written to a scratch directory and moved into place, so a save cut
+    # short never leaves a partial cache that the check above would accept.
+    tmp_path = tempfile.mkdtemp(dir="cached_models")
+    try:
+        embed_model._model.save(tmp_path)
+        os.replace(tmp_path, LOCAL_MODEL_PATH)
+        logger.info(f"Model saved locally to: {LOCAL_MODEL_PATH}")
+    except OSError as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.warning(f"Could not cache embedding model at {LOCAL_MODEL_PATH}: {str(e)}")
+    return embed_model
+
+@lru_cache(maxsize=1)
 def initialize_vector_db():
+    # One store per process, so its SQLAlchemy connection pools are created
+    # once and kept warm for every query instead of per index load
     try:
         logger.info("Initializing PostgreSQL vector store")
         vector_store = PGVectorStore.from_params(
@@ -61,31 +122,144 @@ def initialize_vector_db():
             password=os.getenv("PG_PASSWORD", "postgres"),
             table_name=os.getenv("PG_TABLE_NAME", "rag_documents"),
             embed_dim=int(os.getenv("EMBED_DIM", "768")),
+            hybrid_search=False,
+            perform_setup=True,
+            create_engine_kwargs={"pool_size": 2, "max_overflow": 8},
         )
         return vector_store
     except Exception as e:
         logger.error(f"Failed to initialize vector DB: {e}", exc_info=True)
         raise e
 
+def read_pdf_pages(path: str) -> List[Document]:
+    # One Document per page, with the same metadata keys PDFReader produced.
+    # MuPDF extracts text in C, far faster than the pure-Python pypdf.
+    with pymupdf.open(path) as pdf:
+        return [
+            Document(
+                text=page.get_text("text"),
+                metadata={
+                    "page_label": page.get_label() or str(page.number + 1),
+                    "file_name": os.path.basename(path),
+                },
+            )
+            for page in pdf
+        ]
+
+def find_pdf_paths(folder_path: str) -> List[str]:
+    return [
+        os.path.join(root, fname)
+        for root, _, files in os.walk(folder_path)
+        for fname in files
+        if fname.lower().endswith(".pdf")
+    ]
+
 def load_all_pdfs_from_folder(folder_path: str):
-    reader = PDFReader()
     all_docs = []
     if not os.path.exists(folder_path):
         logger.warning(f"PDF directory does not exist: {folder_path}")
         return all_docs
 
-    for root, _, files in os.walk(folder_path):
-        for fname in files:
-            if fname.lower().endswith(".pdf"):
-                path = os.path.join(root, fname)
-                try:
-                    docs = reader.load_data(file=path)
-                    all_docs.extend(docs)
-                    logger.info(f"Loaded {len(docs)} docs from {path}")
-                except Exception as e:
-                    logger.warning(f"Failed to read {path}: {str(e)}")
+    pdf_paths = find_pdf_paths(folder_path)
+
+    # Parsed one file at a time: PyMuPDF is not thread-safe and holds the GIL,
+    # so a thread pool risks crashes without any speed-up
+    for path in pdf_paths:
+        try:
+            docs = read_pdf_pages(path)
+            logger.info(f"Loaded {len(docs)} docs from {path}")
+            all_docs.extend(docs)
+        except Exception as e:
+            logger.warning(f"Failed to read {path}: {str(e)}")
     return all_docs
 
+def index_fingerprint(folder_path: str) -> str:
+    # Identifies what a rebuild would produce: the embedding model, the
+    # parsing and chunking settings, and every PDF's relative path and content
+    files = []
+    for path in sorted(find_pdf_paths(folder_path)):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        files.append([os.path.relpath(path, folder_path), digest.hexdigest()])
+    inputs = {
+        "model": HF_MODEL_NAME,
+        "embed_dim": os.getenv("EMBED_DIM", "768"),
+        "parser": [PDF_PARSER_VERSION, pymupdf.VersionBind],
+        "chunking": [CHUNK_SIZE, CHUNK_OVERLAP],
+        "files": files,
+    }
+    return hashlib.sha256(json.dumps(inputs).encode("utf-8")).hexdigest()
+
+def index_is_current(vector_store: PGVectorStore, fingerprint: str) -> bool:
+    # True only if the vector table exists, holds rows, and was last built
+    # from these inputs according to the record stored beside it in Postgres
+    table_name = f"data_{vector_store.table_name}"
+    schema = vector_store.schema_name
+    engine = create_engine(vector_store.connection_string)
+    try:
+        inspector = inspect(engine)
+        if not inspector.has_table(table_name, schema=schema):
+            logger.info(f"Vector table {table_name} does not exist yet")
+            return False
+        with engine.connect() as conn:
+            if conn.execute(text(f'SELECT 1 FROM "{schema}"."{table_name}" LIMIT 1')).first() is None:
+                logger.warning(f"Vector table {table_name} is empty")
+                return False
+            if not inspector.has_table(INDEX_BUILDS_TABLE, schema=schema):
+                return False
+            row = conn.execute(
+                text(f'SELECT fingerprint FROM "{schema}"."{INDEX_BUILDS_TABLE}" WHERE table_name = :table_name'),
+                {"table_name": table_name},
+            ).first()
+        return row is not None and row[0] == fingerprint
+    finally:
+        engine.dispose()
+
+def mark_index_built(vector_store: PGVectorStore, fingerprint: str):
+    # Records the inputs the vector table was built from; an empty
+    # fingerprint marks a rebuild in progress, so one cut short is redone
+    table_name = f"data_{vector_store.table_name}"
+    schema = vector_store.schema_name
+    engine = create_engine(vector_store.connection_string)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{schema}"."{INDEX_BUILDS_TABLE}" ('
+                "table_name VARCHAR PRIMARY KEY, "
+                "fingerprint VARCHAR NOT NULL, "
+                "built_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            ))
+            conn.execute(
+                text(
+                    f'INSERT INTO "{schema}"."{INDEX_BUILDS_TABLE}" (table_name, fingerprint) '
+                    "VALUES (:table_name, :fingerprint) "
+                    "ON CONFLICT (table_name) DO UPDATE "
+                    "SET fingerprint = EXCLUDED.fingerprint, built_at = now()"
+                ),
+                {"table_name": table_name, "fingerprint": fingerprint},
+            )
+    finally:
+        engine.dispose()
+
+def ensure_hnsw_index(vector_store: PGVectorStore):
+    # Without an ANN index pgvector answers every query with an exact scan
+    # over all rows. HNSW matches the store's cosine distance queries.
+    table_name = f"data_{vector_store.table_name}"
+    engine = create_engine(vector_store.connection_string)
+    try:
+        if not inspect(engine).has_table(table_name, schema=vector_store.schema_name):
+            return
+        with engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS "{table_name}_embedding_hnsw" '
+                f'ON "{vector_store.schema_name}"."{table_name}" '
+                "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+            ))
+    finally:
+        engine.dispose()
+
 def load_or_create_index(docs=None, embed_model=None, force_reload=False):
     try:
         vector_store = initialize_vector_db()
@@ -93,19 +267,26 @@ def load_or_create_index(docs=None, embed_model=None, force_reload=False):
             if docs is None or embed_model is None:
                 raise ValueError("Documents and embed_model are required on force reload")
             logger.info("Creating new vector store index...")
+            # Rebuild rather than append, so repeated reloads don't duplicate rows
+            vector_store.clear()
             index = VectorStoreIndex.from_documents(
                 docs,
-                vector_store=vector_store,
+                storage_context=StorageContext.from_defaults(vector_store=vector_store),
                 embed_model=embed_model
             )
             logger.info("Index created")
-            return index
         else:
             logger.info("Loading index from vector store...")
-            return VectorStoreIndex.from_vector_store(
+            index = VectorStoreIndex.from_vector_store(
                 vector_store=vector_store,
                 embed_model=embed_model
             )
+
+        try:
+            ensure_hnsw_index(vector_store)
+        except Exception as e:
+            logger.warning(f"Could not create HNSW index, queries will use exact search: {str(e)}")
+        return index
     except Exception as e:
         logger.error(f"Error in load_or_create_index: {str(e)}", exc_info=True)
         raise e
@@ -120,54 +301,70 @@ async def lifespan(app: FastAPI):
         if global_index is not None and os.getenv("FORCE_RELOAD_INDEX", "false").lower() != "true":
             logger.info("Using cached index")
             app.state.index = global_index
+            app.state.query_engine = global_index.as_query_engine()
             yield
             return
 
-        # ─── Embedding Model Loading (with local cache support) ────────────────
-        HF_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
-        LOCAL_MODEL_PATH = os.path.join("cached_models", HF_MODEL_NAME.replace("/", "_"))
+        # ─── Startup Lock ───────────────────────────────────────────────────────
+        # Under `uvicorn --workers N` every worker runs this lifespan. The first
+        # one to take the lock downloads the model and, on force reload, indexes
+        # the PDFs. The rest wait for it to finish, then load the model from the
+        # local cache and attach to the populated vector store. Holding the lock
+        # only means no one else is starting up right now, so whether to rebuild
+        # is decided by the marker checked under the lock, not by leadership.
         os.makedirs("cached_models", exist_ok=True)
+        startup_lock = FileLock(STARTUP_LOCK_PATH)
+        try:
+            startup_lock.acquire(timeout=0)
+            is_leader = True
+        except Timeout:
+            logger.info("Another worker is preparing the model and index, waiting for it")
+            with startup_lock.acquire(timeout=STARTUP_LOCK_TIMEOUT):
+                pass
+            is_leader = False
 
-        if os.path.exists(LOCAL_MODEL_PATH) and os.listdir(LOCAL_MODEL_PATH):
-            logger.info(f"Loading embedding model from local cache: {LOCAL_MODEL_PATH}")
-            embed_model = HuggingFaceEmbedding(
-                model_name=LOCAL_MODEL_PATH,
-                device=DEVICE
-            )
-        else:
-            logger.info(f"Downloading embedding model: {HF_MODEL_NAME}")
-            embed_model = HuggingFaceEmbedding(
-                model_name=HF_MODEL_NAME,
-                device=DEVICE
+        try:
+            # ─── Embedding Model Loading (with local cache support) ────────────
+            embed_model = load_embed_model()
+
+            # ─── Gemini LLM ─────────────────────────────────────────────────────
+            llm = Gemini(
+                model=os.getenv("GEMINI_MODEL", "gemini-2.0-flash"),
+                api_key=GOOGLE_API_KEY,
+                temperature=0.3,
+                max_tokens=1024
             )
-            SentenceTransformer(HF_MODEL_NAME).save(LOCAL_MODEL_PATH)
-            logger.info(f"Model saved locally to: {LOCAL_MODEL_PATH}")
-
-        # ─── Gemini LLM ─────────────────────────────────────────────────────────
-        llm = Gemini(
-            model=os.getenv("GEMINI_MODEL", "gemini-2.0-flash"),
-            api_key=GOOGLE_API_KEY,
-            temperature=0.3,
-            max_tokens=1024
-        )
 
-        # ─── Settings ───────────────────────────────────────────────────────────
-        Settings.llm = llm
-        Settings.embed_model = embed_model
-        Settings.node_parser = SentenceSplitter(chunk_size=1024, chunk_overlap=20)
-        Settings.num_output = 2048
-        Settings.context_window = 4000
+            # ─── Settings ───────────────────────────────────────────────────────
+            Settings.llm = llm
+            Settings.embed_model = embed_model
+            Settings.node_parser = SentenceSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+            Settings.num_output = 2048
+            Settings.context_window = 4000
 
-        # ─── Index Creation/Loading ─────────────────────────────────────────────
-        force_reload = os.getenv("FORCE_RELOAD_INDEX", "false").lower() == "true"
-        if force_reload:
-            logger.info("Force reload enabled. Reading and indexing PDFs...")
-            docs = load_all_pdfs_from_folder(BASE_PDF_DIR)
-            index = load_or_create_index(docs=docs, embed_model=embed_model, force_reload=True)
-        else:
-            index = load_or_create_index(embed_model=embed_model)
+            # ─── Index Creation/Loading ─────────────────────────────────────────
+            force_reload = os.getenv("FORCE_RELOAD_INDEX", "false").lower() == "true"
+            vector_store = initialize_vector_db()
+            fingerprint = index_fingerprint(BASE_PDF_DIR) if force_reload and is_leader else None
+            if fingerprint and not index_is_current(vector_store, fingerprint):
+                logger.info("Force reload enabled. Reading and indexing PDFs...")
+                mark_index_built(vector_store, "")
+                docs = load_all_pdfs_from_folder(BASE_PDF_DIR)
+                index = load_or_create_index(docs=docs, embed_model=embed_model, force_reload=True)
+                mark_index_built(vector_store, fingerprint)
+            else:
+                if fingerprint:
+                    logger.info("Index is already built from the current inputs, loading it")
+                elif force_reload:
+                    logger.info("Index was prepared by another worker, loading it")
+                index = load_or_create_index(embed_model=embed_model)
+        finally:
+            if is_leader:
+                startup_lock.release()
 
         app.state.index = index
+        # Built once here; get_query_engine() hands the same engine to every request
+        app.state.query_engine = index.as_query_engine()
         global_index = index
 
         logger.info(f"Application startup complete in {time.time() - start_time:.2f}s")
@@ -179,6 +376,6 @@ async def lifespan(app: FastAPI):
 
 def get_query_engine(request: Request):
     logger.debug("Query engine requested")
-    if not hasattr(request.app.state, "index"):
+    if not hasattr(request.app.state, "query_engine"):
         raise RuntimeError("RAG index not initialized")
-    return request.app.state.index.as_query_engine()
+    return request.app.state.query_engine
@@ -1,33 +1,102 @@
 # Fix for chatbot.py
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from datetime import datetime, timezone
 from collections import deque
+from cachetools import TTLCache
 from typing import Any, Optional
 
-import os, mimetypes, tempfile, httpx, logging
-from config.database import get_session
+import asyncio, os, shutil, tempfile, logging
+from config.database import SessionLocal, get_session
 from models.models import ChatbotInteraction, User
-from models.schema import ChatbotRequest, ChatbotResponse
+from models.schema import ChatbotBatchResponse, ChatbotRequest, ChatbotResponse
 from rag.query_engine import get_query_engine
 from routers.auth import get_current_user
-from routers.helpers.helper import extract_urls, handle_content
+from routers.helpers.cache import make_key, response_cache
+from routers.helpers.helper import extract_urls, get_http_client, guess_mime, handle_content, public_urls
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 MAX_HISTORY = 5
+# Most interactions a single history request may return
+MAX_HISTORY_PAGE = 100
+# Placeholder replies that are dropped from the response
+_SENTINELS = {"Empty Response"}
+# Recent messages per user id, so the history isn't re-read on every request.
+# Per process only; a miss just falls back to the database.
+_HISTORY: TTLCache = TTLCache(maxsize=10_000, ttl=600)
 prompt_header = """
   you are Code&Clause, designed to assist with the clearance of Information Technology projects by public institutions.
   You can also provide efficient, enjoyable, and secure service by processing applications, sending notices, verifying identity, resolving disputes, managing risk, and improving NITDA services.
   You can also help detect, prevent, or remediate violations of laws, regulations, standards, guidelines, and frameworks, as well as track information breaches and manage information technology and physical infrastructure.
 """
+# Prepended to every RAG query; built once rather than per request
+_PROMPT_PREFIX = prompt_header.rstrip() + "\n"
+
+def _persist(user_id: str, user_input: str, response: str, timestamp: datetime):
+    """Stores one interaction in its own session, after the response has been sent"""
+    with SessionLocal() as session:
+        session.add(ChatbotInteraction(
+            user_id=user_id,
+            user_input=user_input,
+            response=response,
+            timestamp=timestamp,
+        ))
+        session.commit()
+
+
+async def _process_file(file: UploadFile, user_input: Optional[str], temp_files: list[str]) -> str:
+    """
+    Processes the uploaded file, returning its reply or an error message.
+    The temp copy is added to temp_files for the caller to clean up.
+    """
+    logger.info(f"Processing file: {file.filename}, content type: {file.content_type}")
+    suffix = os.path.splitext(file.filename)[1]
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    temp_files.append(tmp.name)
+    # copy in 1 MiB chunks off the event loop instead of reading the whole upload into memory
+    with tmp:
+        await run_in_threadpool(shutil.copyfileobj, file.file, tmp, 1 << 20)
+
+    mime = file.content_type or guess_mime(file.filename)
+    logger.info(f"File MIME type: {mime}")
+
+    try:
+        response = await handle_content(tmp.name, mime, user_input or "Analyze this file.")
+        if response:
+            logger.info("File processing succeeded")
+            return response
+        logger.warning("File processing returned empty response")
+        return "I couldn't process this file type properly."
+    except Exception as e:
+        logger.error(f"Error handling file content: {str(e)}", exc_info=True)
+        return f"Error processing file: {str(e)}"
+
+
+async def _process_url(url: str, user_input: str) -> str:
+    """Processes one URL from the user's message, returning its reply or an error message"""
+    try:
+        # guess mime from headers or extension
+        head = await get_http_client().head(url)
+        mime = head.headers.get("Content-Type") or guess_mime(url)
+        logger.info(f"URL MIME type: {mime}")
+
+        url_response = await handle_content(url, mime, user_input)
+        if url_response:
+            return url_response
+        return f"Couldn't process URL: {url}"
+    except Exception as e:
+        logger.warning(f"Error processing URL {url}: {str(e)}")
+        return f"Error processing URL {url}: {str(e)}"
+
 
 @router.post(
     "/chatbot/",
     response_model=ChatbotResponse,
+    response_class=ORJSONResponse,
     summary="Chat with text, file, or link",
 )
 async def chatbot_post(
@@ -38,84 +107,71 @@ async def chatbot_post(
     query_engine=Depends(get_query_engine),
     background_tasks: BackgroundTasks = BackgroundTasks(),
 ) -> Any:
-    logger.info(f"Received request with user_input: {user_input}, file: {file is not None}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Received request with user_input: {user_input}, file: {file is not None}")
     
     if not user_input and not file:
         raise HTTPException(400, "Provide text, file, or URL links")
 
     # load recent history (for logging)
-    past = (
-        db.query(ChatbotInteraction)
-          .filter_by(user_id=current_user.id)
-          .order_by(ChatbotInteraction.timestamp.desc())
-          .limit(MAX_HISTORY)
-          .all()
-    )
-    history = deque(maxlen=MAX_HISTORY)
-    for msg in reversed(past):
-        history.extend([msg.user_input, msg.response])
+    history = _HISTORY.get(current_user.id)
+    if history is None:
+        past = (
+            db.query(ChatbotInteraction)
+              .with_entities(ChatbotInteraction.user_input, ChatbotInteraction.response)
+              .filter_by(user_id=current_user.id)
+              .order_by(ChatbotInteraction.timestamp.desc())
+              .limit(MAX_HISTORY)
+              .all()
+        )
+        history = deque(maxlen=MAX_HISTORY)
+        for msg in reversed(past):
+            history.extend([msg.user_input, msg.response])
+        _HISTORY[current_user.id] = history
 
     response_texts: list[str] = []
     temp_files_to_remove = []
 
     try:
-        # 1) If a file is uploaded
+        # 1) the uploaded file and 2) any URLs in the text, processed concurrently
+        tasks = []
         if file:
-            logger.info(f"Processing file: {file.filename}, content type: {file.content_type}")
-            suffix = os.path.splitext(file.filename)[1]
-            tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
-            content = await file.read()
-            tmp.write(content)
-            tmp.flush()
-            tmp.close()
-            temp_files_to_remove.append(tmp.name)
-
-            mime = file.content_type or mimetypes.guess_type(file.filename)[0]
-            logger.info(f"File MIME type: {mime}")
-            
-            try:
-                response = await handle_content(tmp.name, mime, user_input or "Analyze this file.")
-                if response:
-                    response_texts.append(response)
-                    logger.info("File processing succeeded")
-                else:
-                    logger.warning("File processing returned empty response")
-                    response_texts.append("I couldn't process this file type properly.")
-            except Exception as e:
-                logger.error(f"Error handling file content: {str(e)}", exc_info=True)
-                response_texts.append(f"Error processing file: {str(e)}")
-
-        # 2) URLs in the text
+            tasks.append(_process_file(file, user_input, temp_files_to_remove))
         if user_input:
-            urls = extract_urls(user_input)
-            logger.info(f"Extracted URLs: {urls}")
-            
-            for url in urls:
-                try:
-                    # guess mime from headers or extension
-                    head = httpx.head(url, timeout=10.0)
-                    mime = head.headers.get("Content-Type", mimetypes.guess_type(url)[0])
-                    logger.info(f"URL MIME type: {mime}")
-                    
-                    url_response = await handle_content(url, mime, user_input)
-                    if url_response:
-                        response_texts.append(url_response)
-                    else:
-                        response_texts.append(f"Couldn't process URL: {url}")
-                except Exception as e:
-                    logger.error(f"Error processing URL {url}: {str(e)}", exc_info=True)
-                    response_texts.append(f"Error processing URL {url}: {str(e)}")
-
-        response_texts = [r.strip() for r in response_texts if r and r.strip() and "Empty Response" not in r]
+            urls = await asyncio.to_thread(public_urls, extract_urls(user_input))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"Extracted URLs: {urls}")
+            tasks.extend(_process_url(url, user_input) for url in urls)
+
+        # each source reports its own errors; anything that escapes becomes an error reply
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Error processing request content: {str(result)}", exc_info=result)
+                response_texts.append(f"Error processing request: {str(result)}")
+            else:
+                response_texts.append(result)
+
+        cleaned = []
+        for r in response_texts:
+            stripped = r.strip() if r else ""
+            if stripped and stripped not in _SENTINELS:
+                cleaned.append(stripped)
+        response_texts = cleaned
         
         # 3) Fallback to text-only RAG if still nothing
         if not response_texts and user_input:
             logger.info("Falling back to text-only RAG")
             try:
-                query_text = prompt_header + "\n" + user_input
-                out = query_engine.query(query_text)
-                if out and getattr(out, "response", "").strip():
-                    response_texts.append(out.response.strip())
+                query_text = _PROMPT_PREFIX + user_input
+                cache_key = make_key(query_text)
+                answer = response_cache.get(cache_key)
+                if answer is None:
+                    out = await query_engine.aquery(query_text)
+                    answer = (getattr(out, "response", None) or "").strip()
+                    if answer:
+                        response_cache.set(cache_key, answer)
+                if answer:
+                    response_texts.append(answer)
                     logger.info("RAG query succeeded")
                 else:
                     logger.warning("RAG query returned empty response")
@@ -126,23 +182,19 @@ async def chatbot_post(
         
         # 4) Assemble final response
         final_resp = "\n\n".join(response_texts) or "I'm having trouble generating a response right now."
-        logger.info(f"Final response generated with length: {len(final_resp)}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Final response generated with length: {len(final_resp)}")
 
-        # persist
-        record = ChatbotInteraction(
-            user_id=current_user.id,
+        # persist once the response is on its way
+        reply = ChatbotResponse(
             user_input=user_input or (file.filename if file else "<empty>"),
             response=final_resp,
             timestamp=datetime.now(timezone.utc),
         )
-        db.add(record)
-        db.commit()
+        background_tasks.add_task(_persist, current_user.id, reply.user_input, reply.response, reply.timestamp)
+        history.extend([reply.user_input, reply.response])
 
-        return ChatbotResponse(
-            user_input=record.user_input,
-            response=final_resp,
-            timestamp=record.timestamp,
-        )
+        return reply
     
     except Exception as e:
         logger.error(f"Unexpected error in chatbot endpoint: {str(e)}", exc_info=True)
@@ -154,15 +206,57 @@ async def chatbot_post(
             background_tasks.add_task(os.remove, tmp_file)
 
 
-@router.get("/chatbot/history/", response_model=None)
-async def get_chat_history(
-    db: Session = Depends(get_session), current_user: User = Depends(get_current_user)
-) -> Any:
-    chat_history = (
+def load_chat_history(db: Session, user_id: str, skip: int = 0, limit: int = MAX_HISTORY_PAGE) -> list[dict]:
+    """
+    Returns up to `limit` of the user's interactions in chronological order,
+    ending `skip` interactions before the most recent one
+    """
+    rows = (
         db.query(ChatbotInteraction)
-        .filter(ChatbotInteraction.user_id == current_user.id)
-        .order_by(ChatbotInteraction.timestamp.asc())
+        .with_entities(ChatbotInteraction.user_input, ChatbotInteraction.response, ChatbotInteraction.timestamp)
+        .filter(ChatbotInteraction.user_id == user_id)
+        .order_by(ChatbotInteraction.timestamp.desc())
+        .offset(skip)
+        .limit(limit)
         .all()
     )
+    return [row._asdict() for row in reversed(rows)]
+
 
-    return chat_history
\ No newline at end of file
+@router.post(
+    "/chatbot/batch",
+    response_model=ChatbotBatchResponse,
+    response_class=ORJSONResponse,
+    summary="Chat and fetch the updated history in one round trip",
+)
+async def chatbot_batch(
+    user_input: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    history_limit: int = Form(MAX_HISTORY_PAGE, ge=1, le=MAX_HISTORY_PAGE),  # entries returned, new reply included
+    db: Session = Depends(get_session),
+    current_user: User = Depends(get_current_user),
+    query_engine=Depends(get_query_engine),
+    background_tasks: BackgroundTasks = BackgroundTasks(),
+) -> Any:
+    reply = await chatbot_post(
+        user_input=user_input,
+        file=file,
+        db=db,
+        current_user=current_user,
+        query_engine=query_engine,
+        background_tasks=background_tasks,
+    )
+    # the reply is persisted in the background, so it isn't in the database yet
+    history = load_chat_history(db, current_user.id, limit=history_limit - 1) if history_limit > 1 else []
+    history.append(reply)
+    return {"reply": reply, "history": history}
+
+
+@router.get("/chatbot/history/", response_model=None, response_class=ORJSONResponse)
+async def get_chat_history(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(MAX_HISTORY_PAGE, ge=1, le=MAX_HISTORY_PAGE),
+    db: Session = Depends(get_session),
+    current_user: User = Depends(get_current_user),
+) -> Any:
+    return load_chat_history(db, current_user.id, skip=skip, limit=limit)
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""
+This module provides an in-memory TTL cache for generated chatbot responses
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Optional
+
+# Content larger than this is not hashed or cached
+MAX_CACHEABLE_BYTES = 10 * 1024 * 1024
+
+
+class QueryCache:
+    """Thread-safe TTL cache mapping query keys to response texts"""
+
+    def __init__(self, default_ttl: int = 3600, max_size: int = 1000):
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self._entries: dict[str, tuple[float, float, str]] = {}  # key -> (stored_at, expires_at, response)
+        self._lock = threading.RLock()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._entries[key]
+                return None
+            return entry[2]
+
+    def set(self, key: str, response: str, ttl: Optional[int] = None):
+        """Caches response under key, evicting the oldest entry when full"""
+        now = time.time()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_size:
+                self._evict(now)
+            self._entries[key] = (now, now + (ttl or self.default_ttl), response)
+
+    def clear(self):
+        """Removes every cached response"""
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self, now: float):
+        expired = [key for key, entry in self._entries.items() if entry[1] < now]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) >= self.max_size:
+            oldest = min(self._entries, key=lambda key: self._entries[key][0])
+            del self._entries[oldest]
+
+
+def make_key(query: Optional[str], data: Optional[bytes] = None) -> Optional[str]:
+    """
+    Returns the cache key for a query, optionally over some content,
+    or None when the content is too large to cache
+    """
+    if data is not None and len(data) > MAX_CACHEABLE_BYTES:
+        return None
+    return make_digest_key(query, hashlib.sha256(data).hexdigest() if data is not None else "")
+
+
+def make_digest_key(query: Optional[str], content_digest: str) -> str:
+    """
+    Returns the cache key for a query over content whose sha256 hex digest
+    was computed by the caller, e.g. incrementally while streaming it
+    """
+    normalized = (query or "").lower().strip() + content_digest[:16]
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()
+
+
+def make_file_key(query: Optional[str], path: str) -> Optional[str]:
+    """Returns the cache key for a query over a local file's content"""
+    if os.path.getsize(path) > MAX_CACHEABLE_BYTES:
+        return None
+    with open(path, "rb") as f:
+        return make_key(query, f.read())
+
+
+# Shared by the file, URL and RAG paths of the chatbot
+response_cache = QueryCache()
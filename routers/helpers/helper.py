@@ -1,24 +1,154 @@
 import os
 import re
-import io
+import asyncio
+import hashlib
 import pathlib
+import io
 import tempfile
 import mimetypes
+import socket
+import ipaddress
+import threading
 import httpx
+import httpcore
 import logging
 from google import genai, generativeai
 from google.genai import types
+from cachetools import TTLCache, cached as ttl_cached
+from functools import lru_cache
 from typing import Optional, Any
+from urllib.parse import urlsplit
+
+from routers.helpers.cache import MAX_CACHEABLE_BYTES, make_digest_key, make_file_key, make_key, response_cache
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared async client for fetching user-supplied URLs; closed on app shutdown.
+# HTTP/2 lets repeated fetches from one host share a single TLS connection.
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared client, creating it on first use or after it was closed"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            transport=_public_only_transport(
+                http2=True,
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+            ),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+    return _http_client
+
+async def close_http_client():
+    """Closes the shared client; the next get_http_client() call opens a new one"""
+    global _http_client
+    if _http_client is not None:
+        client, _http_client = _http_client, None
+        await client.aclose()
+
+# basic http(s) URL regex, compiled once at import
+_URL_RE = re.compile(r'https?://[^\s]+')
+
 def extract_urls(text: Optional[str]) -> list[str]:
-    if not text:
-        return []
-    # basic http(s) URL regex
-    return re.findall(r'(https?://[^\s]+)', text)
+    # drop repeated links, keeping the order they first appear in
+    return list(dict.fromkeys(_URL_RE.findall(text))) if text else []
+
+def _all_global(addresses: list[str]) -> bool:
+    # strip any IPv6 scope id ("fe80::1%eth0") before parsing
+    return bool(addresses) and all(ipaddress.ip_address(a.split("%")[0]).is_global for a in addresses)
+
+# Verdicts expire quickly so a re-pointed domain is re-resolved. This is only
+# an early reject before any request is made; _PublicOnlyBackend enforces the
+# rule again on every connection.
+@ttl_cached(TTLCache(maxsize=1024, ttl=60), lock=threading.Lock())
+def _is_public_host(host: str) -> bool:
+    """True if every address the host resolves to is publicly routable"""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except (socket.gaierror, UnicodeError):
+        return False
+    return _all_global([info[4][0] for info in infos])
+
+def _public_addresses(host: str, port: int) -> list[str]:
+    """Resolves host and returns its addresses in resolver order, refusing non-public hosts"""
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise httpcore.ConnectError(f"Could not resolve {host}: {str(e)}") from e
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    if not _all_global(addresses):
+        raise httpcore.ConnectError(f"Refusing to connect to non-public host {host}")
+    return addresses
+
+class _PublicOnlyBackend(httpcore.AsyncNetworkBackend):
+    """
+    Resolves each host at connect time and connects to the vetted addresses
+    itself, so a DNS answer that changes after public_urls() checked the URL
+    (DNS rebinding) still can't reach an internal service. TLS verification
+    and SNI keep using the URL's hostname.
+    """
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addresses = await asyncio.to_thread(_public_addresses, host, port)
+        # try each record in turn, as connecting by hostname would; e.g. an
+        # unreachable IPv6 address on an IPv4-only host falls through to IPv4
+        last_error = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(
+                    address, port, timeout=timeout, local_address=local_address, socket_options=socket_options
+                )
+            except httpcore.ConnectError as e:
+                last_error = e
+        raise last_error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("Unix socket connections are not allowed")
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+def _public_only_transport(**kwargs) -> httpx.AsyncHTTPTransport:
+    transport = httpx.AsyncHTTPTransport(**kwargs)
+    # httpx has no option for the network backend, so swap it into the pool it
+    # built. These are private attributes of the httpx/httpcore versions pinned
+    # in requirements.txt; fail loudly if an upgrade moves them, rather than
+    # silently fetching through the default, unchecked backend.
+    pool = getattr(transport, "_pool", None)
+    if not isinstance(pool, httpcore.AsyncConnectionPool) or not hasattr(pool, "_network_backend"):
+        raise RuntimeError("Unsupported httpx/httpcore version: cannot install the public-address check")
+    pool._network_backend = _PublicOnlyBackend()
+    return transport
+
+def public_urls(urls: list[str]) -> list[str]:
+    """
+    Drops URLs whose host is loopback, private, link-local or otherwise
+    non-public, so user-supplied links can't reach internal services.
+    Resolves hostnames, so call it off the event loop.
+    """
+    allowed = []
+    for url in urls:
+        try:
+            host = urlsplit(url).hostname
+        except ValueError as e:  # e.g. "Invalid IPv6 URL" for "http://[bad/"
+            logger.warning(f"Skipping malformed URL {url}: {str(e)}")
+            continue
+        if host and _is_public_host(host):
+            allowed.append(url)
+        else:
+            logger.warning(f"Skipping URL with non-public host: {url}")
+    return allowed
+
+# load the system MIME tables at import rather than on the first request
+mimetypes.init()
+
+@lru_cache(maxsize=1024)
+def guess_mime(path: str) -> Optional[str]:
+    return mimetypes.guess_type(path)[0]
 
 # Initialize Google API client
 try:
@@ -33,6 +163,28 @@ except Exception as e:
     logger.error(f"Error initializing Google AI client: {str(e)}", exc_info=True)
     raise
 
+# User-supplied content is sent with relaxed safety filters on the first call,
+# rather than retrying blocked prompts with them
+GENERATION_CONFIG = types.GenerateContentConfig(
+    safety_settings=[
+        types.SafetySetting(category=category, threshold=types.HarmBlockThreshold.BLOCK_NONE)
+        for category in (
+            types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+            types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+            types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        )
+    ],
+)
+
+def _cached_response(cache_key: Optional[str]) -> Optional[str]:
+    if cache_key is None:
+        return None
+    cached = response_cache.get(cache_key)
+    if cached:
+        logger.info("Returning cached response")
+    return cached
+
 async def handle_content(
     source: str,            # either local path or a URL
     mime_type: str|None,    # hint, e.g. 'application/pdf'
@@ -42,35 +194,60 @@ async def handle_content(
     
     if not mime_type:
         logger.warning(f"No MIME type provided for {source}, will try to guess")
-        mime_type = mimetypes.guess_type(source)[0]
+        mime_type = guess_mime(source)
         logger.info(f"Guessed MIME type: {mime_type}")
     
     contents: list[Any] = []
     temp_files = []
+    cache_key: Optional[str] = None  # set once the content is loaded
     
     try:
-        # — PDF (remote or local) via in‑memory BytesIO for large files
+        # — PDF: remote files are streamed to disk and uploaded, local ones sent inline
         if mime_type == "application/pdf":
             logger.info("Processing PDF content")
             # fetch remote if it's a URL
             if source.startswith("http"):
                 try:
-                    response = httpx.get(source, timeout=30.0)
-                    data = response.content
+                    tmp = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+                    temp_files.append(tmp.name)
+                    # hash while streaming so the file is never read back; past the
+                    # cacheable size the PDF just isn't cached
+                    digest, size = hashlib.sha256(), 0
+                    with tmp:
+                        async with get_http_client().stream("GET", source) as response:
+                            # an error page must not be uploaded as the PDF
+                            response.raise_for_status()
+                            async for chunk in response.aiter_bytes(1 << 20):
+                                tmp.write(chunk)
+                                size += len(chunk)
+                                if size <= MAX_CACHEABLE_BYTES:
+                                    digest.update(chunk)
                 except Exception as e:
-                    logger.error(f"Error fetching PDF from URL {source}: {str(e)}", exc_info=True)
+                    logger.warning(f"Error fetching PDF from URL {source}: {str(e)}")
                     return f"Error fetching PDF: {str(e)}"
+
+                cache_key = make_digest_key(user_input, digest.hexdigest()) if size <= MAX_CACHEABLE_BYTES else None
+                if cached := _cached_response(cache_key):
+                    return cached
+
+                upload_ref = await client.aio.files.upload(
+                    file=tmp.name,
+                    config=types.UploadFileConfig(mime_type="application/pdf"),
+                )
+                contents.append(upload_ref)
             else:
                 try:
-                    with open(source, "rb") as f:
-                        data = f.read()
+                    data = await asyncio.to_thread(pathlib.Path(source).read_bytes)
                 except Exception as e:
-                    logger.error(f"Error reading PDF file {source}: {str(e)}", exc_info=True)
+                    logger.warning(f"Error reading PDF file {source}: {str(e)}")
                     return f"Error reading PDF file: {str(e)}"
-            
-            # wrap in Part directly
-            part = types.Part.from_bytes(data=data, mime_type="application/pdf")
-            contents.append(part)
+
+                cache_key = await asyncio.to_thread(make_key, user_input, data)
+                if cached := _cached_response(cache_key):
+                    return cached
+
+                # wrap in Part directly
+                contents.append(types.Part.from_bytes(data=data, mime_type="application/pdf"))
             contents.append(user_input or "Summarize this document.")
             
         # — Image
@@ -79,23 +256,30 @@ async def handle_content(
             try:
                 # local or remote path to file
                 if source.startswith("http"):
-                    resp = httpx.get(source, timeout=30.0)
-                    tmp = tempfile.NamedTemporaryFile(suffix=pathlib.Path(source).suffix, delete=False)
-                    tmp.write(resp.content)
-                    tmp.flush()
-                    tmp.close()
-                    temp_files.append(tmp.name)
-                    file_to_use = tmp.name
+                    resp = await get_http_client().get(source)
+                    resp.raise_for_status()
+                    cache_key = await asyncio.to_thread(make_key, user_input, resp.content)
+                    if cached := _cached_response(cache_key):
+                        return cached
+
+                    # upload the fetched bytes directly instead of via a temp file
+                    logger.info(f"Uploading image from {source}")
+                    upload_ref = await client.aio.files.upload(
+                        file=io.BytesIO(resp.content),
+                        config=types.UploadFileConfig(mime_type=mime_type),
+                    )
                 else:
-                    file_to_use = source
-                
-                logger.info(f"Uploading image file: {file_to_use}")
-                upload_ref = client.files.upload(file=file_to_use)
+                    cache_key = await asyncio.to_thread(make_file_key, user_input, source)
+                    if cached := _cached_response(cache_key):
+                        return cached
+
+                    logger.info(f"Uploading image file: {source}")
+                    upload_ref = await client.aio.files.upload(file=source)
                 
                 contents.append(upload_ref)
                 contents.append(user_input or "Caption this image.")
             except Exception as e:
-                logger.error(f"Error processing image: {str(e)}", exc_info=True)
+                logger.warning(f"Error processing image: {str(e)}")
                 return f"Error processing image: {str(e)}"
             
         # — Audio
@@ -103,23 +287,30 @@ async def handle_content(
             logger.info("Processing audio content")
             try:
                 if source.startswith("http"):
-                    resp = httpx.get(source, timeout=30.0)
-                    tmp = tempfile.NamedTemporaryFile(suffix=pathlib.Path(source).suffix, delete=False)
-                    tmp.write(resp.content)
-                    tmp.flush()
-                    tmp.close()
-                    temp_files.append(tmp.name)
-                    file_to_use = tmp.name
+                    resp = await get_http_client().get(source)
+                    resp.raise_for_status()
+                    cache_key = await asyncio.to_thread(make_key, user_input, resp.content)
+                    if cached := _cached_response(cache_key):
+                        return cached
+
+                    # upload the fetched bytes directly instead of via a temp file
+                    logger.info(f"Uploading audio from {source}")
+                    upload_ref = await client.aio.files.upload(
+                        file=io.BytesIO(resp.content),
+                        config=types.UploadFileConfig(mime_type=mime_type),
+                    )
                 else:
-                    file_to_use = source
-                
-                logger.info(f"Uploading audio file: {file_to_use}")
-                upload_ref = client.files.upload(file=file_to_use)
+                    cache_key = await asyncio.to_thread(make_file_key, user_input, source)
+                    if cached := _cached_response(cache_key):
+                        return cached
+
+                    logger.info(f"Uploading audio file: {source}")
+                    upload_ref = await client.aio.files.upload(file=source)
                 
                 contents.append(user_input or "Describe this audio clip.")
                 contents.append(upload_ref)
             except Exception as e:
-                logger.error(f"Error processing audio: {str(e)}", exc_info=True)
+                logger.warning(f"Error processing audio: {str(e)}")
                 return f"Error processing audio: {str(e)}"
             
         # — Plain text / HTML / JSON
@@ -127,16 +318,22 @@ async def handle_content(
             logger.info("Processing text content")
             try:
                 if source.startswith("http"):
-                    resp = httpx.get(source, timeout=30.0)
+                    resp = await get_http_client().get(source)
+                    resp.raise_for_status()
                     text_data = resp.text
                 else:
-                    with open(source, "r", encoding="utf-8", errors="ignore") as f:
-                        text_data = f.read()
+                    text_data = await asyncio.to_thread(
+                        pathlib.Path(source).read_text, encoding="utf-8", errors="ignore"
+                    )
                 
+                cache_key = await asyncio.to_thread(lambda: make_key(user_input, text_data.encode("utf-8")))
+                if cached := _cached_response(cache_key):
+                    return cached
+
                 contents.append(text_data)
                 contents.append(user_input or "Summarize this content.")
             except Exception as e:
-                logger.error(f"Error processing text content: {str(e)}", exc_info=True)
+                logger.warning(f"Error processing text content: {str(e)}")
                 return f"Error processing text content: {str(e)}"
         else:
             logger.warning(f"Unsupported MIME type: {mime_type or 'unknown'}")
@@ -145,48 +342,30 @@ async def handle_content(
         # generate with Gemini
         logger.info("Calling Gemini API")
         try:
-            # Try with safety settings adjusted if needed
-            generation_config = {
-                "temperature": 0.7,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": 2048,
-            }
-            
-            safety_settings = {
-                "HARASSMENT": "BLOCK_NONE",
-                "HATE": "BLOCK_NONE",
-                "SEXUAL": "BLOCK_NONE",
-                "DANGEROUS": "BLOCK_NONE",
-            }
-            
-            try:
-                # First try with default settings
-                resp = client.models.generate_content(
-                    model="gemini-2.0-flash", 
-                    contents=contents,
-                )
-            except Exception as e:
-                if "blocked" in str(e).lower() or "safety" in str(e).lower():
-                    logger.warning(f"Initial generation blocked by safety settings, retrying with adjusted settings: {str(e)}")
-                    # Try with adjusted safety settings
-                    resp = client.models.generate_content(
-                        model="gemini-2.0-flash", 
-                        contents=contents,
-                        safety_settings=safety_settings
-                    )
-                else:
-                    raise
-            
-            if hasattr(resp, 'text') and resp.text:
-                logger.info(f"Successfully generated response, length: {len(resp.text)}")
+            resp = await client.aio.models.generate_content(
+                model="gemini-2.0-flash",
+                contents=contents,
+                config=GENERATION_CONFIG,
+            )
+
+            # a blocked prompt comes back as feedback rather than an exception
+            feedback = getattr(resp, "prompt_feedback", None)
+            if feedback and feedback.block_reason:
+                logger.warning(f"Gemini blocked the prompt: {feedback.block_reason}")
+                return "I couldn't generate a response for this content."
+
+            if resp.text:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(f"Successfully generated response, length: {len(resp.text)}")
+                if cache_key:
+                    response_cache.set(cache_key, resp.text)
                 return resp.text
             else:
                 logger.warning("Empty response from Gemini API")
                 return "I couldn't generate a response for this content."
                 
         except Exception as e:
-            logger.error(f"Error generating content with Gemini: {str(e)}", exc_info=True)
+            logger.warning(f"Error generating content with Gemini: {str(e)}")
             return f"Error generating response: {str(e)}"
     
     except Exception as e: